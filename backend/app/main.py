@@ -1,113 +1,252 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import logging
+import queue
+import zlib
+from logging.handlers import QueueHandler, QueueListener
 import asyncpg
+import orjson
 import uvicorn
-from fastapi.responses import HTMLResponse
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi import FastAPI, Depends, Request, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import csv
-from io import StringIO
+from io import TextIOWrapper
 
 from models import (Train, Section, Connection, TrainType, Stop, RailBlock, NetworkDTO, SectionDTO, ConnectionDTO, StopDTO)
 from simulation import SimulationEngine
 
-app = FastAPI(title="TrainSim", version="1.0.0")
+# records are queued by the event loop and written to stderr by a background thread
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+logger = logging.getLogger("trainsim")
+logger.setLevel(logging.WARNING)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-engine: Optional[SimulationEngine] = None
-db_pool: Optional[asyncpg.pool.Pool] = None
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib encoder."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 class ConnectionManager:
+    MAX_CONCURRENT_SENDS = 256
+    CLIENT_QUEUE_SIZE = 16
+    # a client that can't take a frame within this many seconds is dropped instead of holding a send slot
+    SEND_TIMEOUT = 5.0
+
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # each client gets a bounded outbox drained by its own writer task
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        # clients that just connected or lost a frame; each gets the full state with its next batch
+        # instead of deltas it can't apply, without forcing keyframes on everyone else
+        self.resync: Set[WebSocket] = set()
+        # caps how many sends are in flight at once when fanning out to a large audience
+        self.send_limit = asyncio.Semaphore(self.MAX_CONCURRENT_SENDS)
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.CLIENT_QUEUE_SIZE)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
+        self.resync.add(websocket)
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-    async def broadcast(self, data: dict):
-        for connection in self.active_connections:
-            try: await connection.send_json(data)
-            except: pass
+        self.active_connections.pop(websocket, None)
+        self.resync.discard(websocket)
+        writer = self.writers.pop(websocket, None)
+        if writer: writer.cancel()
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                payload = await queue.get()
+                async with self.send_limit:
+                    await asyncio.wait_for(websocket.send_bytes(payload), self.SEND_TIMEOUT)
+        except Exception:
+            # drop clients whose send failed or stalled
+            self.disconnect(websocket)
+    def broadcast(self, payload: bytes, keyframe: Optional[bytes] = None):
+        # payloads are serialized and compressed once by the caller and shared by every client as binary frames;
+        # a slow client loses its oldest frame instead of stalling the simulation loop, and is resynced alone
+        for websocket, queue in self.active_connections.items():
+            if queue.full():
+                queue.get_nowait()
+                self.resync.add(websocket)
+            if websocket in self.resync:
+                # deltas are useless to a client out of sync: hold them back until a keyframe is offered
+                if keyframe is None: continue
+                self.resync.discard(websocket)
+                queue.put_nowait(keyframe)
+            else:
+                queue.put_nowait(payload)
 
 manager = ConnectionManager()
 
-async def simulation_loop(tick_rate: int = 10):
+# ticks coalesced into one WebSocket frame: amortizes framing and syscalls at the cost of
+# up to (BROADCAST_BATCH_TICKS - 1) ticks of extra latency
+BROADCAST_BATCH_TICKS = 2
+# ticks between full-state frames; the ones in between only carry changed and removed trains
+KEYFRAME_TICKS = 50
+EMPTY_DELTA = b'{"type":"delta","changed":[],"removed":[]}'
+
+async def _compress_and_broadcast(raw: bytes, keyframe_raw: Optional[bytes], previous: Optional[asyncio.Task]):
+    try:
+        # deflate in a worker thread (zlib releases the GIL) while the loop moves on to the next tick
+        payload = await asyncio.to_thread(zlib.compress, raw, 1)
+        keyframe = keyframe_raw and await asyncio.to_thread(zlib.compress, keyframe_raw, 1)
+        # keep batches in order if the previous one is still compressing; wait() doesn't re-raise its
+        # failure (already logged by that task), so one bad batch can't stop every later broadcast
+        if previous is not None: await asyncio.wait([previous])
+        manager.broadcast(payload, keyframe)
+    except Exception:
+        logger.exception("Broadcast Error")
+
+async def simulation_loop(engine: SimulationEngine, tick_rate: int = 10):
     real_dt = 1.0 / tick_rate
+    loop = asyncio.get_running_loop()
+    last_t = loop.time()
+    next_t = last_t + real_dt
+    frame_version = None
+    prev_trains: Dict[int, bytes] = {}
+    tick = 0
+    batch = []
+    sender: Optional[asyncio.Task] = None
     while True:
-        if engine:
-            try:
-                await engine.run_tick(real_dt)
-                # Get trains and wagons data
-                trains_data = await engine.get_trains_with_wagons()
-                # broadcast tick to connected clients
-                await manager.broadcast({"type": "tick", "trains": trains_data})
-            except Exception as e:
-                print(f"Sim Loop Error: {e}")
-        await asyncio.sleep(real_dt)
-
-@app.on_event("startup")
-async def startup():
-    global engine, db_pool
+        # advance by the real elapsed time, capped so a long stall can't skip whole sections
+        now = loop.time()
+        elapsed = min(now - last_t, 5 * real_dt)
+        last_t = now
+        try:
+            await engine.run_tick(elapsed)
+            if not manager.active_connections:
+                # nobody is listening: skip encoding, a client that connects gets a keyframe
+                batch.clear()
+            else:
+                version = engine.state_version
+                keyframe = tick % KEYFRAME_TICKS == 0
+                tick += 1
+                if keyframe:
+                    prev_trains = await engine.get_encoded_trains()
+                    frame = b'{"type":"tick","trains":[' + b','.join(prev_trains.values()) + b']}'
+                    frame_version = version
+                elif version != frame_version:
+                    # trains are encoded one by one, so comparing their bytes to the previous tick finds what changed
+                    trains = await engine.get_encoded_trains()
+                    changed = [t for tid, t in trains.items() if prev_trains.get(tid) != t]
+                    removed = [tid for tid in prev_trains if tid not in trains]
+                    # the version also moves on changes clients don't see; those still make an empty delta
+                    frame = (b'{"type":"delta","changed":[' + b','.join(changed) + b'],"removed":' + orjson.dumps(removed) + b'}'
+                             if changed or removed else EMPTY_DELTA)
+                    prev_trains = trains
+                    frame_version = version
+                else:
+                    frame = EMPTY_DELTA
+                batch.append(frame)
+                if len(batch) >= BROADCAST_BATCH_TICKS:
+                    # prev_trains is the state after the batch's last frame: clients that need a resync get
+                    # it as a one-frame batch in place of the shared one
+                    keyframe_raw = None
+                    if manager.resync:
+                        keyframe_raw = b'{"type":"ticks","frames":[{"type":"tick","trains":[' + b','.join(prev_trains.values()) + b']}]}'
+                    if keyframe_raw is None and all(f is EMPTY_DELTA for f in batch):
+                        # nothing moved: don't wake the clients for a batch they would ignore
+                        batch.clear()
+                    else:
+                        # the frames are already JSON, join them into the envelope without re-encoding;
+                        # serialized and deflated once for all connected clients
+                        raw = b'{"type":"ticks","frames":[' + b','.join(batch) + b']}'
+                        batch.clear()
+                        sender = asyncio.create_task(_compress_and_broadcast(raw, keyframe_raw, sender))
+        except Exception:
+            logger.exception("Sim Loop Error")
+        # sleep until the next deadline instead of a fixed real_dt, so work time doesn't add drift
+        delay = next_t - loop.time()
+        if delay < 0:
+            # fell behind: resync rather than firing a burst of catch-up ticks
+            next_t = loop.time()
+            delay = 0
+        next_t += real_dt
+        await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
     DB_DSN = "postgres://myuser:mypassword@db:5432/mydb"
     
+    db_pool: Optional[asyncpg.pool.Pool] = None
     sections, connections, train_types, rail_blocks, stops = [], [], [], [], []
     
     try:
-        db_pool = await asyncpg.create_pool(dsn=DB_DSN)
+        # kept open for the request handlers; small on purpose, only /api/network queries at runtime
+        db_pool = await asyncpg.create_pool(dsn=DB_DSN, min_size=2, max_size=10, max_inactive_connection_lifetime=300)
         async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT section_id FROM sections")
-            sections = [Section(section_id=r['section_id']) for r in rows]
+            # one read-only repeatable-read transaction, so all five tables come from the same snapshot
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                rows = await conn.fetch("SELECT section_id FROM sections")
+                sections = [Section(r[0]) for r in rows]
             
-            rows = await conn.fetch("SELECT from_section_id, to_section_id, COALESCE(exclude_previous_block_name, NULL) as exclude_previous_block_name FROM section_connections")
-            connections = [Connection(**dict(r)) for r in rows]
-
-            rows = await conn.fetch("SELECT train_type_id, type_name, priority_index, cruising_speed FROM train_types")
-            train_types = [TrainType(**dict(r)) for r in rows]
-
-            rows = await conn.fetch("SELECT block_id, block_name, section_id FROM rail_blocks")
-            # Group sections by block_name
-            blocks_dict = {}
-            for row in rows:
-                block_name = row['block_name']
-                section_id = row['section_id']
-                if block_name not in blocks_dict:
-                    blocks_dict[block_name] = []
-                blocks_dict[block_name].append(section_id)
+                rows = await conn.fetch("SELECT from_section_id, to_section_id, COALESCE(exclude_previous_block_name, NULL) as exclude_previous_block_name FROM section_connections")
+                connections = [Connection(*r) for r in rows]
+
+                rows = await conn.fetch("SELECT train_type_id, type_name, priority_index, cruising_speed FROM train_types")
+                train_types = [TrainType(*r) for r in rows]
+
+                rows = await conn.fetch("SELECT block_name, section_id FROM rail_blocks ORDER BY block_id")
+                # Group sections by block_name
+                blocks_dict = {}
+                for block_name, section_id in rows:
+                    blocks_dict.setdefault(block_name, []).append(section_id)
             
-            # Create RailBlock objects
-            rail_blocks = [
-                RailBlock(block_name=name, sections=[Section(section_id=sid) for sid in section_ids])
-                for name, section_ids in blocks_dict.items()
-            ]
+                # Create RailBlock objects
+                rail_blocks = [
+                    RailBlock(block_name=name, sections=[Section(section_id=sid) for sid in section_ids])
+                    for name, section_ids in blocks_dict.items()
+                ]
 
-            rows = await conn.fetch("SELECT stop_id, stop_name, section_id FROM stops")
-            stops = [Stop(**dict(r)) for r in rows]
+                rows = await conn.fetch("SELECT stop_id, stop_name, section_id FROM stops")
+                stops = [Stop(*r) for r in rows]
     except Exception as e:
-        print(f"DB Error: {e}. Starting empty.")
+        logger.warning("DB Error: %s. Starting empty.", e)
 
     engine = SimulationEngine(sections, connections, train_types, rail_blocks, stops)
-    asyncio.create_task(simulation_loop())
+    app.state.engine = engine
+    app.state.db_pool = db_pool
+    sim_task = asyncio.create_task(simulation_loop(engine))
 
-@app.on_event("shutdown")
-async def shutdown():
+    yield
+
+    sim_task.cancel()
     if db_pool:
         await db_pool.close()
+    log_listener.stop()
 
-@app.get("/api/network", response_model=NetworkDTO)
-async def get_network_topology():
-    """
-    Returns the static network map: sections, connections, and stops.
-    """
+app = FastAPI(title="TrainSim", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+def get_db_pool(request: Request) -> asyncpg.pool.Pool:
+    db_pool = request.app.state.db_pool
     if not db_pool:
         raise HTTPException(status_code=503, detail="Database not available")
+    return db_pool
 
+# NetworkDTO is only advertised in the OpenAPI schema: the response is built from
+# trusted DB rows, so it skips FastAPI's outbound validation and is dumped by orjson directly
+@app.get("/api/network", response_model=None, responses={200: {"model": NetworkDTO}})
+async def get_network_topology(db_pool: asyncpg.pool.Pool = Depends(get_db_pool)):
+    """
+    Returns the static network map: sections, connections, and stops.
+    """
     async with db_pool.acquire() as conn:
         rows_sections = await conn.fetch("""
             SELECT s.section_id, COALESCE(b.block_name, 'UNKNOWN') as block_name
@@ -126,88 +265,111 @@ async def get_network_topology():
             FROM stops
         """)
 
-        return {
-            "sections": [
+        return ORJSONResponse(NetworkDTO(
+            sections=[
                 SectionDTO(section_id=r["section_id"], block_name=r["block_name"]) 
                 for r in rows_sections
             ],
-            "connections": [
+            connections=[
                 ConnectionDTO(from_id=r["from_section_id"], to_id=r["to_section_id"]) 
                 for r in rows_connections
             ],
-            "stops": [
+            stops=[
                 StopDTO(stop_id=r["stop_id"], stop_name=r["stop_name"], section_id=r["section_id"])
                 for r in rows_stops
             ]
-        }
+        ))
+
+# required CSV columns and their converters, in Train field order
+TRAIN_CSV_COLUMNS = (
+    ('train_id', int),
+    ('train_code', str),
+    ('train_type_id', int),
+    ('current_section_id', int),
+    ('num_wagons', int),
+)
+
+def _parse_trains_csv(stream) -> List[Train]:
+    """Parses the uploaded CSV straight from the spooled upload file, row by row."""
+    text = TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        reader = csv.reader(text)
+        # resolve column positions once from the header instead of building a dict per row
+        header = {name: i for i, name in enumerate(next(reader, []))}
+        columns = tuple((header[name], convert) for name, convert in TRAIN_CSV_COLUMNS)
+        stop_idx = header.get('desired_stop_id')
+
+        new_trains = []
+        for row in reader:
+            if not row: continue
+            train_id, train_code, train_type_id, current_section_id, num_wagons = (convert(row[i]) for i, convert in columns)
+            d_stop = row[stop_idx] if stop_idx is not None and stop_idx < len(row) else None
+            final_stop_id = int(d_stop) if d_stop and d_stop.strip() else None
+
+            new_trains.append(Train(
+                train_id=train_id,
+                train_code=train_code,
+                train_type_id=train_type_id,
+                current_section_id=current_section_id,
+                num_wagons=num_wagons,
+                desired_stop_id=final_stop_id,
+                status='Moving'
+            ))
+        return new_trains
+    finally:
+        # don't let the wrapper close the upload file, UploadFile owns it
+        text.detach()
 
 @app.post("/api/v1/load_trains")
-async def api_load_trains(file: UploadFile = File(...)):
+async def api_load_trains(request: Request, file: UploadFile = File(...)):
     """Expected CSV structure: train_id, train_code, train_type_id, current_section_id, num_wagons, desired_stop_id"""
-    if not engine: raise HTTPException(503, "Engine not ready")
-    
-    content = await file.read()
-    reader = csv.DictReader(StringIO(content.decode('utf-8')))
+    engine: SimulationEngine = request.app.state.engine
     
-    new_trains = []
-    for row in reader:
-        d_stop = row.get('desired_stop_id')
-        final_stop_id = int(d_stop) if d_stop and d_stop.strip() else None
-
-        new_trains.append(Train(
-            train_id=int(row['train_id']),
-            train_code=row['train_code'],
-            train_type_id=int(row['train_type_id']),
-            current_section_id=int(row['current_section_id']),
-            num_wagons=int(row.get('num_wagons')),
-            desired_stop_id=final_stop_id,
-            status='Moving'
-        ))
+    # parse in a worker thread so the simulation loop keeps ticking during big uploads
+    try:
+        new_trains = await asyncio.to_thread(_parse_trains_csv, file.file)
+    except (KeyError, IndexError, ValueError, csv.Error) as e:
+        # missing column, short row, non-numeric field, bad encoding or malformed CSV (e.g. an oversized field)
+        raise HTTPException(status_code=400, detail=f"Invalid trains CSV: {e!r}")
     
     await engine.add_trains(new_trains)
     return {"Added": len(new_trains)}
 
 @app.delete("/api/v1/trains")
-async def clear_all_trains():
+async def clear_all_trains(request: Request):
     """Removes all trains and wagons from the simulation."""
-    if not engine: 
-        raise HTTPException(status_code=503, detail="Engine not ready")
-    
-    # safely modify state while simulation loop is running
-    async with engine.lock:
-        engine.trains.clear()
-        engine.wagons.clear()
-        engine.train_wagons.clear()
-        engine.train_history.clear()
-
-        # reset track occupancy
-        engine._update_section_occupancy()
-        
+    engine: SimulationEngine = request.app.state.engine
+    await engine.clear_trains()
     return {"message": "All trains cleared"}
 
 @app.post("/api/v1/simulation/pause")
-async def pause_simulation():
-    if not engine: raise HTTPException(503, "Engine not ready")
-    engine.set_paused(True)
+async def pause_simulation(request: Request):
+    request.app.state.engine.set_paused(True)
     return {"status": "paused"}
 
 @app.post("/api/v1/simulation/resume")
-async def resume_simulation():
-    if not engine: raise HTTPException(503, "Engine not ready")
-    engine.set_paused(False)
+async def resume_simulation(request: Request):
+    request.app.state.engine.set_paused(False)
     return {"status": "running"}
 
 @app.get("/api/v1/simulation/debug")
-async def get_simulation_debug():
+async def get_simulation_debug(request: Request):
     """Returns the last N debug logs from the simulation engine."""
-    if not engine: raise HTTPException(503, "Engine not ready")
+    engine: SimulationEngine = request.app.state.engine
     
     return {
         "tick": engine.tick_count,
         "paused": engine.paused,
+        "enabled": engine.debug_enabled,
         "logs": list(engine.debug_logs)
     }
 
+@app.put("/api/v1/simulation/debug")
+async def set_simulation_debug(request: Request, enabled: bool):
+    """Turns debug logging on or off; while off, log messages are not even formatted."""
+    request.app.state.engine.debug_enabled = enabled
+    return {"enabled": enabled}
+
 @app.websocket("/ws/traffic")
 async def ws_traffic(websocket: WebSocket):
     await manager.connect(websocket)
@@ -216,13 +378,30 @@ async def ws_traffic(websocket: WebSocket):
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
-@app.get("/ws-debug", response_class=HTMLResponse)
-async def get_debug_ui():
+def _load_debug_page() -> bytes:
     try:
-        with open('./websocket-debug.html', "r") as text_file:
-            return text_file.read()
+        with open('./websocket-debug.html', "rb") as html_file:
+            return html_file.read()
     except FileNotFoundError:
-        return "debug html file not found"
+        return b"debug html file not found"
+
+# the page is static: encode and hash it once instead of on every request
+DEBUG_PAGE = _load_debug_page()
+# weak: GZipMiddleware may serve these same bytes compressed, so the tag can't promise byte equality
+DEBUG_PAGE_ETAG = f'W/"{hashlib.md5(DEBUG_PAGE, usedforsecurity=False).hexdigest()}"'
+
+@app.get("/ws-debug", response_class=HTMLResponse)
+async def get_debug_ui(request: Request):
+    headers = {"ETag": DEBUG_PAGE_ETAG, "Cache-Control": "public, max-age=3600"}
+    # If-None-Match uses weak comparison, so a W/ prefix on either side doesn't matter; "*" matches any
+    # current representation, and this page always has one
+    tags = {t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")}
+    if "*" in tags or DEBUG_PAGE_ETAG[2:] in tags:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=DEBUG_PAGE, headers=headers)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # single worker on purpose: the engine lives in this process and the REST endpoints
+    # mutate it directly, extra workers would each run their own diverging simulation
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", ws="websockets",
+                ws_per_message_deflate=False, log_level="warning", access_log=False)
\ No newline at end of file
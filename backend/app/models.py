@@ -1,20 +1,20 @@
-from typing import List, Optional
+from typing import List, Optional, TypedDict
 from dataclasses import dataclass
 import datetime
 
-@dataclass
+@dataclass(slots=True)
 class Section:
     section_id: int
     is_occupied: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class Connection:
     from_section_id: int
     to_section_id: int
     exclude_previous_block_name: Optional[str] = None
     is_active: bool = True
 
-@dataclass
+@dataclass(slots=True)
 class RailBlock:
     block_name: str
     sections: List[Section]
@@ -22,20 +22,20 @@ class RailBlock:
     def is_occupied(self) -> bool:
         return any(section.is_occupied for section in self.sections)
 
-@dataclass
+@dataclass(slots=True)
 class Stop:
     stop_id: int
     stop_name: str
     section_id: int
 
-@dataclass
+@dataclass(slots=True)
 class TrainType:
     train_type_id: int
     type_name: str
     priority_index: int
     cruising_speed: float
 
-@dataclass
+@dataclass(slots=True)
 class Wagon:
     wagon_id: int
     train_id: int
@@ -43,7 +43,7 @@ class Wagon:
     section_id: Optional[int] = None # if None, the wagon is currently out of frame
     position_offset: float = 0.0
 
-@dataclass
+@dataclass(slots=True)
 class Train:
     train_id: int
     train_code: str
@@ -56,6 +56,18 @@ class Train:
     wait_elapsed: float = 0.0
     previous_block_name: Optional[str] = None # tracks what block the locomotive came from 
 
+class TrainDict(TypedDict):
+    train_id: int
+    train_code: str
+    train_type_id: int
+    current_section_id: int
+    num_wagons: int
+    desired_stop_id: Optional[int]
+    status: str
+    position_offset: float
+    wait_elapsed: float
+    wagons: List[Wagon] # serialized as objects with the Wagon fields
+
 @dataclass
 class SectionDTO:
     section_id: int
@@ -1,8 +1,11 @@
 import asyncio
+import sys
+import orjson
+from bisect import insort
 from collections import deque
+from itertools import islice
 from typing import Dict, List, Optional, Set, Tuple
-from heapq import heappush, heappop
-from models import Section, Connection, TrainType, Train, Wagon, RailBlock, Stop
+from models import Section, Connection, TrainType, Train, Wagon, RailBlock, Stop, TrainDict
 import time
 
 class SimulationEngine:
@@ -20,29 +23,60 @@ class SimulationEngine:
         self.sections: Dict[int, Section] = {s.section_id: s for s in sections}
         self.connections: List[Connection] = connections
         self.train_types: Dict[int, TrainType] = {tt.train_type_id: tt for tt in train_types}
+        # per-second movement rate per train type, computed once as train types never change
+        self._speed_per_sec: Dict[int, float] = {tt.train_type_id: tt.cruising_speed / 60.0 for tt in train_types}
         self.blocks: Dict[str, RailBlock] = {b.block_name: b for b in blocks}
         self.stops: Dict[int, Stop] = {s.stop_id: s for s in stops}
+        # STOP_CONSTRAINTS as booleans: True when the section may only be entered from a lower section id
+        self._enter_from_below: Dict[int, bool] = {sec: side == 'left' for sec, side in self.STOP_CONSTRAINTS.items()}
         
+        # block names are interned (here and in the adjacency), so the block comparisons made on
+        # every crossing and path search resolve on identity instead of comparing characters
         self.section_to_block: Dict[int, str] = {}
         for block in blocks:
+            block_name = sys.intern(block.block_name)
             for section in block.sections:
-                self.section_to_block[section.section_id] = block.block_name
+                self.section_to_block[section.section_id] = block_name
         
         self.network: Dict[int, List[Connection]] = {}
         for conn in connections:
-            if conn.from_section_id not in self.network:
-                self.network[conn.from_section_id] = []
-            self.network[conn.from_section_id].append(conn)
+            self.network.setdefault(conn.from_section_id, []).append(conn)
+        # flat (to_section, excluded previous block) pairs of the *active* connections per section,
+        # read by the pathfinder
+        self.adjacency: Dict[int, Tuple[Tuple[int, Optional[str]], ...]] = {
+            sec: tuple(
+                (c.to_section_id, c.exclude_previous_block_name and sys.intern(c.exclude_previous_block_name))
+                for c in conns if c.is_active
+            )
+            for sec, conns in self.network.items()
+        }
         
         self.trains: Dict[int, Train] = {t.train_id: t for t in trains}
+        # the order run_tick visits trains in, kept sorted as trains come and go instead of sorted every tick
+        self._trains_by_priority: List[Train] = []
+        for t in self.trains.values(): self._insert_by_priority(t)
+        # wagons per section and per block, kept up to date as wagons change section instead of rescanning every tick
+        self._section_refcount: Dict[int, int] = {}
+        self._touched_sections: Set[int] = set() # sections whose is_occupied flag is due for an update
+        self._block_refcount: Dict[str, int] = {}
+        self._occupied_blocks: Set[str] = set()
         self.wagons: Dict[int, Wagon] = {}
         self.train_wagons: Dict[int, List[int]] = {}
         self.train_history: Dict[int, deque] = {}
+        self._next_wagon_id = 1000 # never reused, so a despawned train's wagon ids stay unique
+        self._despawning: Set[int] = set() # trains that reached a despawn point, retired at the end of the tick
         
         # --- NEW: Simulation Control & Debugging ---
         self.paused = False
         self.debug_logs = deque(maxlen=200) # Store last 200 events
+        self.debug_enabled = True # when off, no entries are built (blocked trains log every tick)
         self.tick_count = 0
+        self.state_version = 0 # bumped whenever the broadcast state changes
+        self._encoded_trains: Dict[int, bytes] = {}
+        self._dirty_trains: Set[int] = set() # trains changed since they were last encoded
+        # next hops by (from, target, avoided section, previous block); connections are never switched at
+        # runtime, so entries stay valid for the engine's lifetime
+        self._hop_cache: Dict[Tuple[int, int, Optional[int], Optional[str]], Optional[int]] = {}
         
         self.lock = asyncio.Lock()
         
@@ -55,6 +89,7 @@ class SimulationEngine:
 
     def _log_debug(self, source: str, message: str):
         """Internal helper to add a structured log entry."""
+        if not self.debug_enabled: return
         entry = {
             "tick": self.tick_count,
             "time": time.strftime("%H:%M:%S"),
@@ -63,14 +98,22 @@ class SimulationEngine:
         }
         self.debug_logs.append(entry)
 
+    def _priority_key(self, train: Train) -> int:
+        return -self.train_types[train.train_type_id].priority_index
+
+    def _insert_by_priority(self, train: Train):
+        # highest priority first; insort places a train after the ones of equal priority, so ties keep
+        # their insertion order like the stable sort this replaces
+        insort(self._trains_by_priority, train, key=self._priority_key)
+
     def _initialize_wagons(self):
-        wagon_id = 1000
         for train in self.trains.values():
-            self._create_train_wagons(train, wagon_id)
-            wagon_id += max(1, train.num_wagons)
+            self._create_train_wagons(train)
 
-    def _create_train_wagons(self, train: Train, start_wagon_id: int):
+    def _create_train_wagons(self, train: Train):
         num_wagons = max(1, train.num_wagons)
+        start_wagon_id = self._next_wagon_id
+        self._next_wagon_id += num_wagons
         self.train_wagons[train.train_id] = []
         history = deque([None] * num_wagons, maxlen=num_wagons)
         self.train_history[train.train_id] = history
@@ -82,41 +125,44 @@ class SimulationEngine:
             
             wagon = Wagon(wagon_id, train.train_id, i, section, offset)
             self.wagons[wagon_id] = wagon
+            self._move_wagon_ref(None, section)
             self.train_wagons[train.train_id].append(wagon_id)
-
-    def _get_outgoing_connections(self, from_section: int, exclude_from_block: Optional[str] = None):
-        valid = []
-        for conn in self.network.get(from_section, []):
-            if not conn.is_active: continue
-            if exclude_from_block and conn.exclude_previous_block_name == exclude_from_block:
-                continue
-            valid.append((conn.to_section_id, conn))
-        return valid
+        if train.current_section_id in self.DESPAWN_POINTS:
+            self._despawning.add(train.train_id)
 
     def _can_enter_section(self, section_id: int, from_section_id: int) -> bool:
-        if section_id not in self.STOP_CONSTRAINTS: return True
-        constraint = self.STOP_CONSTRAINTS[section_id]
-        return (from_section_id < section_id) if constraint == 'left' else (from_section_id > section_id)
+        from_below = self._enter_from_below.get(section_id)
+        if from_below is None: return True
+        return (from_section_id < section_id) if from_below else (from_section_id > section_id)
 
     def _dijkstra_pathfinding(self, start: int, target: int, avoid_section: int, exclude_from_block: str):
         if start == target: return None
-        pq = [(0, start, None, 0)] 
+        # edges cost 1, or 1 + REVERSE_PENALTY when the direction flips, so the search expands whole
+        # cost levels instead of pushing every edge through a heap. Within a level each section keeps
+        # its lowest (first_hop, direction), the same tie-break the heap's tuple ordering gave.
+        levels = {0: {start: (None, 0)}}
         visited = set()
-        
-        while pq:
-            cost, current, first_hop, prev_dir = heappop(pq)
-            if current in visited: continue
-            visited.add(current)
-            if current == target: return first_hop
-            
-            for next_sec, conn in self._get_outgoing_connections(current, exclude_from_block):
-                if next_sec == avoid_section: continue
-                curr_dir = 1 if next_sec > current else -1
-                move_cost = 1
-                if prev_dir != 0 and curr_dir != prev_dir:
-                    move_cost += self.REVERSE_PENALTY
-                new_hop = first_hop if first_hop is not None else next_sec
-                heappush(pq, (cost + move_cost, next_sec, new_hop, curr_dir))
+
+        while levels:
+            cost = min(levels)
+            frontier = levels.pop(cost)
+            if target in frontier: return frontier[target][0]
+
+            for current, (first_hop, prev_dir) in frontier.items():
+                if current in visited: continue
+                visited.add(current)
+
+                for next_sec, excluded_block in self.adjacency.get(current, ()):
+                    if next_sec == avoid_section or next_sec in visited: continue
+                    if exclude_from_block and excluded_block == exclude_from_block: continue
+                    curr_dir = 1 if next_sec > current else -1
+                    move_cost = 1
+                    if prev_dir != 0 and curr_dir != prev_dir:
+                        move_cost += self.REVERSE_PENALTY
+                    entry = (first_hop if first_hop is not None else next_sec, curr_dir)
+                    level = levels.setdefault(cost + move_cost, {})
+                    best = level.get(next_sec)
+                    if best is None or entry < best: level[next_sec] = entry
         return None
 
     def _find_next_section(self, from_sec: int, train: Train, occupied_blocks: Set[str], prev_sec: int) -> Optional[int]:
@@ -125,10 +171,16 @@ class SimulationEngine:
              target = self.stops[train.desired_stop_id].section_id
 
         current_block = self.section_to_block.get(from_sec)
-        next_hop = self._dijkstra_pathfinding(from_sec, target, prev_sec, train.previous_block_name)
+        # the search only depends on its arguments and the active connections, so it is answered once;
+        # the signal and occupancy checks below still run per train
+        key = (from_sec, target, prev_sec, train.previous_block_name)
+        if key in self._hop_cache:
+            next_hop = self._hop_cache[key]
+        else:
+            next_hop = self._hop_cache[key] = self._dijkstra_pathfinding(*key)
         
         if next_hop is None: 
-            self._log_debug(train.train_id, f"No path found to target {target} from {from_sec}")
+            if self.debug_enabled: self._log_debug(train.train_id, f"No path found to target {target} from {from_sec}")
             return None
 
         next_block = self.section_to_block.get(next_hop)
@@ -136,22 +188,26 @@ class SimulationEngine:
         if next_block and next_block != current_block:
              if next_block in occupied_blocks:
                  # Debug: Log red signal
-                 self._log_debug(train.train_id, f"Red Signal at Block {next_block}")
+                 if self.debug_enabled: self._log_debug(train.train_id, f"Red Signal at Block {next_block}")
                  return None 
         
         if not self._can_enter_section(next_hop, from_sec): 
             return None
         
         if self.sections[next_hop].is_occupied:
-             self._log_debug(train.train_id, f"Section {next_hop} physically occupied")
+             if self.debug_enabled: self._log_debug(train.train_id, f"Section {next_hop} physically occupied")
              return None
 
         return next_hop
 
     async def add_trains(self, new_trains: List[Train]):
         async with self.lock:
-            wagon_id = max((w.wagon_id for w in self.wagons.values()), default=1000) + 1
+            added = False
             for train in new_trains:
+                if train.train_type_id not in self.train_types:
+                    # checked before touching any state: the priority order and speed both need the type
+                    self._log_debug("SPAWN", f"Unknown train type {train.train_type_id} for Train {train.train_id}")
+                    continue
                 if train.current_section_id in self.sections:
                     if self.sections[train.current_section_id].is_occupied:
                         self._log_debug("SPAWN", f"Spawn blocked for Train {train.train_id} at {train.current_section_id}")
@@ -159,24 +215,79 @@ class SimulationEngine:
 
                 if train.train_id not in self.trains:
                     self.trains[train.train_id] = train
-                    self._create_train_wagons(train, wagon_id)
-                    wagon_id += max(1, train.num_wagons)
+                    self._insert_by_priority(train)
+                    self._dirty_trains.add(train.train_id)
+                    self._create_train_wagons(train)
+                    added = True
                     self._log_debug("SPAWN", f"Train {train.train_id} added at {train.current_section_id}")
             
+            if added: self.state_version += 1
+            self._flush_section_occupancy()
+
+    async def clear_trains(self):
+        """Removes all trains and wagons from the simulation."""
+        async with self.lock:
+            self.trains.clear()
+            self.wagons.clear()
+            self.train_wagons.clear()
+            self.train_history.clear()
+            self._trains_by_priority.clear()
+            self._despawning.clear()
+            self._dirty_trains.clear()
+            # rebound, not cleared: the loop still holds the old dict to diff the next delta against
+            self._encoded_trains = {}
+            self.state_version += 1
+
+            # reset track occupancy
             self._update_section_occupancy()
 
     def _update_section_occupancy(self):
+        """Rebuilds all occupancy state from the wagons; ticks keep it up to date incrementally."""
+        self._section_refcount.clear()
+        self._touched_sections.clear()
+        self._block_refcount.clear()
+        self._occupied_blocks.clear()
         for s in self.sections.values(): s.is_occupied = False
         for w in self.wagons.values():
-            if w.section_id is not None: self.sections[w.section_id].is_occupied = True
+            self._move_wagon_ref(None, w.section_id)
+        self._flush_section_occupancy()
+
+    def _flush_section_occupancy(self):
+        # is_occupied flags are published once per tick (and after spawns), as the full rescan used to do,
+        # so every train in a tick sees the sections occupied when it started
+        sections, refcount = self.sections, self._section_refcount
+        for sid in self._touched_sections:
+            sections[sid].is_occupied = sid in refcount
+        self._touched_sections.clear()
+
+    def _move_wagon_ref(self, old_section: Optional[int], new_section: Optional[int]):
+        """Moves one wagon's occupancy from old_section (and its block) to new_section (and its block)."""
+        if old_section == new_section: return
+        section_refcount = self._section_refcount
+        if old_section is not None:
+            section_refcount[old_section] -= 1
+            if not section_refcount[old_section]: del section_refcount[old_section]
+            self._touched_sections.add(old_section)
+        if new_section is not None:
+            section_refcount[new_section] = section_refcount.get(new_section, 0) + 1
+            self._touched_sections.add(new_section)
+
+        old_blk = self.section_to_block.get(old_section)
+        new_blk = self.section_to_block.get(new_section)
+        if old_blk == new_blk: return
+        refcount = self._block_refcount
+        if old_blk:
+            refcount[old_blk] -= 1
+            if not refcount[old_blk]:
+                del refcount[old_blk]
+                self._occupied_blocks.discard(old_blk)
+        if new_blk:
+            refcount[new_blk] = refcount.get(new_blk, 0) + 1
+            self._occupied_blocks.add(new_blk)
 
     def _get_occupied_blocks(self) -> Set[str]:
-        occupied = set()
-        for w in self.wagons.values():
-            if w.section_id is not None:
-                blk = self.section_to_block.get(w.section_id)
-                if blk: occupied.add(blk)
-        return occupied
+        # a copy: decisions within a tick are made against the blocks occupied when it started
+        return set(self._occupied_blocks)
 
     async def run_tick(self, dt: float):
         async with self.lock:
@@ -185,15 +296,16 @@ class SimulationEngine:
 
             self.tick_count += 1
             occupied_blocks = self._get_occupied_blocks()
+            changed = False
+            # bound once per tick instead of looked up on self for every train
+            speed_per_sec, train_wagons, train_history = self._speed_per_sec, self.train_wagons, self.train_history
+            wagons, section_to_block, stops = self.wagons, self.section_to_block, self.stops
+            dirty, despawning, despawn_points = self._dirty_trains, self._despawning, self.DESPAWN_POINTS
             
-            sorted_trains = sorted(
-                self.trains.values(),
-                key=lambda t: self.train_types[t.train_type_id].priority_index,
-                reverse=True
-            )
-
-            for train in sorted_trains:
+            for train in self._trains_by_priority:
                 if train.status == 'Stopping':
+                    changed = True
+                    dirty.add(train.train_id)
                     train.wait_elapsed += dt
                     if train.wait_elapsed >= self.STOP_DURATION:
                         train.status = 'Moving'
@@ -204,13 +316,12 @@ class SimulationEngine:
                 
                 if train.status != 'Moving': continue
 
-                train_type = self.train_types.get(train.train_type_id)
-                move_amount = (train_type.cruising_speed / 60.0) * dt
+                move_amount = speed_per_sec[train.train_type_id] * dt
                 
-                wagon_ids = self.train_wagons.get(train.train_id, [])
+                wagon_ids = train_wagons.get(train.train_id, [])
                 if not wagon_ids: continue
-                head = self.wagons[wagon_ids[0]]
-                history = self.train_history[train.train_id]
+                head = wagons[wagon_ids[0]]
+                history = train_history[train.train_id]
                 
                 prev_sec = history[0] if history and len(history) > 0 else None
                 direction = 1 
@@ -229,6 +340,8 @@ class SimulationEngine:
                         # We already logged why inside _find_next_section
 
                 if move_amount > 0:
+                    changed = True
+                    dirty.add(train.train_id)
                     if direction == 1: head.position_offset += move_amount
                     else: head.position_offset -= move_amount
 
@@ -236,71 +349,92 @@ class SimulationEngine:
                         history.appendleft(head.section_id)
                         old_sec = head.section_id
                         head.section_id = next_sec
+                        self._move_wagon_ref(old_sec, next_sec)
                         
                         new_dir = 1 if next_sec > old_sec else -1
                         head.position_offset = 0.0 if new_dir == 1 else 1.0
                         
-                        old_blk = self.section_to_block.get(old_sec)
-                        new_blk = self.section_to_block.get(next_sec)
+                        old_blk = section_to_block.get(old_sec)
+                        new_blk = section_to_block.get(next_sec)
                         if new_blk and new_blk != old_blk:
                             train.previous_block_name = old_blk
-                            self._log_debug(train.train_id, f"Entered Block {new_blk} (Sec {next_sec})")
+                            if self.debug_enabled: self._log_debug(train.train_id, f"Entered Block {new_blk} (Sec {next_sec})")
 
-                        if train.desired_stop_id and train.desired_stop_id in self.stops:
-                            if head.section_id == self.stops[train.desired_stop_id].section_id:
+                        stop = stops.get(train.desired_stop_id) if train.desired_stop_id else None
+                        if stop is not None:
+                            if next_sec == stop.section_id:
                                 train.status = 'Stopping'
                                 self._log_debug(train.train_id, f"Arrived at Stop {train.desired_stop_id}")
 
-                        elif train.current_section_id in self.DESPAWN_POINTS:
+                        elif train.current_section_id in despawn_points:
                              self._log_debug(train.train_id, "Despawned at boundary")
                              pass
+
+                        if next_sec in despawn_points: despawning.add(train.train_id)
                     elif will_cross:
                         head.position_offset = 0.99 if direction == 1 else 0.01
 
-                for i in range(1, len(wagon_ids)):
-                    w = self.wagons[wagon_ids[i]]
-                    w.section_id = history[i-1] if (i-1) < len(history) else None
+                # history holds one section per wagon (maxlen == wagon count), so wagon i simply follows
+                # history[i-1]; walk both in lockstep instead of indexing into the deque
+                for wid, new_sec in zip(islice(wagon_ids, 1, None), history):
+                    w = wagons[wid]
+                    if new_sec != w.section_id:
+                        self._move_wagon_ref(w.section_id, new_sec)
+                        w.section_id = new_sec
                     w.position_offset = head.position_offset
 
                 train.current_section_id = head.section_id
                 train.position_offset = head.position_offset
 
-            # Cleanup despawned
-            to_remove = [k for k, v in self.trains.items() if v.current_section_id in self.DESPAWN_POINTS]
-            for tid in to_remove:
-                del self.trains[tid]
-                del self.train_wagons[tid]
-                del self.train_history[tid]
-                # cleanup wagons from self.wagons omitted for brevity, logic exists in previous versions
+            # Cleanup despawned: only the trains that crossed into (or spawned on) a despawn point
+            removed = bool(despawning)
+            if removed:
+                for tid in despawning: self._retire_train(tid)
+                self._trains_by_priority = [t for t in self._trains_by_priority if t.train_id not in despawning]
+                despawning.clear()
 
-            self._update_section_occupancy()
+            if changed or removed: self.state_version += 1
+            self._flush_section_occupancy()
     
-    async def get_trains_with_wagons(self) -> List[dict]:
+    def _retire_train(self, train_id: int):
+        """Removes a train with its wagons and releases the sections they occupied."""
+        del self.trains[train_id]
+        del self.train_history[train_id]
+        self._dirty_trains.discard(train_id)
+        wagons = self.wagons
+        for wid in self.train_wagons.pop(train_id):
+            self._move_wagon_ref(wagons.pop(wid).section_id, None)
+
+    def _train_wagon_list(self, train: Train) -> List[Wagon]:
+        wagons = self.wagons
+        return [wagons[wid] for wid in self.train_wagons.get(train.train_id, []) if wid in wagons]
+
+    def _train_dict(self, train: Train, wagons: List[Wagon]) -> TrainDict:
+        return {
+            "train_id": train.train_id,
+            "train_code": train.train_code,
+            "train_type_id": train.train_type_id,
+            "current_section_id": train.current_section_id,
+            "num_wagons": train.num_wagons,
+            "desired_stop_id": train.desired_stop_id,
+            "status": train.status,
+            "position_offset": train.position_offset,
+            "wait_elapsed": train.wait_elapsed,
+            "wagons": wagons
+        }
+
+    async def get_encoded_trains(self) -> Dict[int, bytes]:
+        """Returns each train serialized on its own, keyed by train_id; only trains that changed are re-encoded."""
         async with self.lock:
-            result = []
-            for train in self.trains.values():
-                wagon_ids = self.train_wagons.get(train.train_id, [])
-                wagons = []
-                for wid in wagon_ids:
-                    if wid in self.wagons:
-                        w = self.wagons[wid]
-                        wagons.append({
-                            "wagon_id": w.wagon_id,
-                            "train_id": w.train_id,
-                            "wagon_index": w.wagon_index,
-                            "section_id": w.section_id,
-                            "position_offset": w.position_offset
-                        })
-                result.append({
-                    "train_id": train.train_id,
-                    "train_code": train.train_code,
-                    "train_type_id": train.train_type_id,
-                    "current_section_id": train.current_section_id,
-                    "num_wagons": train.num_wagons,
-                    "desired_stop_id": train.desired_stop_id,
-                    "status": train.status,
-                    "position_offset": train.position_offset,
-                    "wait_elapsed": train.wait_elapsed,
-                    "wagons": wagons
-                })
-            return result
\ No newline at end of file
+            cached, dirty = self._encoded_trains, self._dirty_trains
+            encoded: Dict[int, bytes] = {}
+            for tid, train in self.trains.items():
+                data = cached.get(tid)
+                if data is None or tid in dirty:
+                    # orjson serializes the Wagon dataclasses directly
+                    data = orjson.dumps(self._train_dict(train, self._train_wagon_list(train)))
+                encoded[tid] = data
+            dirty.clear()
+            # rebuilt on every call, so despawned or cleared trains drop out of the cache
+            self._encoded_trains = encoded
+            return encoded
\ No newline at end of file
@@ -8,6 +8,7 @@ const WS_URL = "ws://localhost:8000/ws/traffic";
 const PAUSE_URL = "http://localhost:8000/api/v1/simulation/pause";
 const RESUME_URL = "http://localhost:8000/api/v1/simulation/resume";
 const DEBUG_URL = "http://localhost:8000/api/v1/simulation/debug";
+const TICK_MS = 100; // backend tick period, used to replay batched ticks
 const GRID_SIZE = 40;
 const TRACK_WIDTH = 6;
 const HIT_AREA_WIDTH = 40;
@@ -108,6 +109,47 @@ const TrainMapLive = () => {
   // --- 2. WEBSOCKET CONNECTION ---
   useEffect(() => {
     const ws = new WebSocket(WS_URL);
+    // ticks arrive as binary frames holding zlib-deflated UTF-8 JSON
+    ws.binaryType = "arraybuffer";
+    const decoder = new TextDecoder();
+    const inflate = (buf) =>
+      new Response(new Blob([buf]).stream().pipeThrough(new DecompressionStream("deflate"))).arrayBuffer();
+    // inflating is async: chain the frames so they are applied in arrival order
+    let pending = Promise.resolve();
+    // latest state per train_id; null until the first full "tick" frame arrives
+    let trainsById = null;
+    const applyFrame = (frame) => {
+      if (frame.type === "tick") {
+        trainsById = new Map(frame.trains.map((t) => [t.train_id, t]));
+      } else if (frame.type === "delta") {
+        if (!trainsById || (!frame.changed.length && !frame.removed.length)) return;
+        frame.changed.forEach((t) => trainsById.set(t.train_id, t));
+        frame.removed.forEach((id) => trainsById.delete(id));
+      } else return;
+      setActiveTrains(Array.from(trainsById.values()));
+    };
+
+    // one playback queue per socket, so batches never interleave: a new batch first applies whatever
+    // is left of the previous one, in order, then replays its own frames TICK_MS apart
+    let queue = [];
+    let timer = null;
+    let lastPlayed = 0;
+    const flushQueue = () => {
+      clearTimeout(timer);
+      timer = null;
+      queue.splice(0).forEach(applyFrame);
+    };
+    const playNext = () => {
+      applyFrame(queue.shift());
+      lastPlayed = performance.now();
+      timer = queue.length ? setTimeout(playNext, TICK_MS) : null;
+    };
+    const playFrames = (frames) => {
+      flushQueue();
+      if (!frames.length) return;
+      queue = frames.slice();
+      timer = setTimeout(playNext, Math.max(0, lastPlayed + TICK_MS - performance.now()));
+    };
 
     ws.onopen = () => {
       console.log("Connected to Traffic Stream");
@@ -115,14 +157,19 @@ const TrainMapLive = () => {
     };
 
     ws.onmessage = (event) => {
-      try {
-        const data = JSON.parse(event.data);
-        if (data.type === "tick") {
-          setActiveTrains(data.trains);
-        }
-      } catch (e) {
-        console.error("WS Parse Error", e);
-      }
+      pending = pending
+        .then(() => (typeof event.data === "string" ? event.data : inflate(event.data).then((buf) => decoder.decode(buf))))
+        .then((text) => {
+          const data = JSON.parse(text);
+          if (data.type === "ticks") {
+            // several ticks per frame: replay them at the simulation rate
+            playFrames(data.frames);
+          } else {
+            flushQueue();
+            applyFrame(data);
+          }
+        })
+        .catch((e) => console.error("WS Parse Error", e));
     };
 
     ws.onclose = () => setWsStatus("DISCONNECTED");
@@ -131,7 +178,10 @@ const TrainMapLive = () => {
       setWsStatus("ERROR");
     };
 
-    return () => ws.close();
+    return () => {
+      clearTimeout(timer);
+      ws.close();
+    };
   }, []);
 
   // --- 3. HANDLERS ---